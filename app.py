@@ -1,15 +1,21 @@
 import streamlit as st
 import pandas as pd
-import pdfplumber
-import trimesh
-import plotly.graph_objects as go
 import numpy as np
+import ahocorasick
+import hashlib
+import io
 import os
+import shutil
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 # --- CONFIGURAÇÃO VISUAL (Anti-Gravity) ---
 st.set_page_config(layout="wide", page_title="IndustriAI Pro | RCC", page_icon="⚙️")
 
-st.markdown("""
+# Emitido a cada execução: o Streamlit remove do DOM o que um rerun não volta a escrever
+ESTILO_CSS = """
 <style>
     .stApp { background-color: #0e1117; color: white; }
     div[data-testid="stSidebar"] { background-color: #161b22; border-right: 1px solid #30363d; }
@@ -19,7 +25,8 @@ st.markdown("""
     .success-box { padding: 1rem; background-color: #1f2937; border: 1px solid #22c55e; border-radius: 8px; margin-bottom: 1rem; }
     .info-box { padding: 1rem; background-color: #1f2937; border: 1px solid #3b82f6; border-radius: 8px; margin-bottom: 1rem; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(ESTILO_CSS, unsafe_allow_html=True)
 
 # --- BASE DE DADOS (Ground Truth RCC Lâminas) ---
 DB_HISTORICO = {
@@ -34,33 +41,240 @@ DB_HISTORICO = {
     }
 }
 
+DB_HISTORICO_NORMALIZADO = {k.lower(): k for k in DB_HISTORICO}
+
+# Autómato Aho-Corasick sobre as chaves do histórico: uma só passagem pelo texto.
+# Reconstruído a cada execução (microssegundos), para acompanhar edições ao DB_HISTORICO.
+AUTOMATON = ahocorasick.Automaton()
+for key_lower, key in DB_HISTORICO_NORMALIZADO.items():
+    AUTOMATON.add_word(key_lower, key)
+AUTOMATON.make_automaton()
+
+# --- MODELO DE CUSTO (simulado) ---
+DENSIDADE_ACO = 7.85 # g/cm³
+PRECO_COEFS = np.array([18.5, 0.0, 120.0], dtype=np.float64) # € por [kg, cm³, fixo]
+
+# Acima disto o Mesh3d (WebGL, um só draw) engasga no browser
+MAX_FACES_WEB = 50_000
+MAX_FIGURAS_SESSAO = 4 # pedidos de figura 3D guardados por sessão
+
 # --- FUNÇÕES ---
+# Módulos pesados (trimesh, pypdf, plotly) só são importados quando a vista precisa deles
+@st.cache_resource(show_spinner=False)
+def _get_trimesh():
+    import trimesh
+    return trimesh
+
+@st.cache_data(show_spinner=False)
+def _extrair_texto_pdf(digest, _pdf_bytes):
+    """Extrai o texto da 1ª página (cache global, chave = MD5 do ficheiro)"""
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(_pdf_bytes))
+    if not reader.pages: return ""
+    # Só precisamos do texto corrido para procurar a chave: pypdf basta (sem layout/tabelas)
+    return reader.pages[0].extract_text() or ""
+
 def ler_pdf_rcc(file):
     """Lê PDF e procura correspondência exata no histórico"""
-    try:
-        with pdfplumber.open(file) as pdf:
-            if not pdf.pages: return False, None, None
-            text = pdf.pages[0].extract_text() or ""
-            
-            for key, data in DB_HISTORICO.items():
-                if key.lower() in text.lower():
-                    return True, key, data
-    except Exception as e:
-        st.error(f"Erro ao ler PDF: {e}")
-    return False, None, None
+    pdf_bytes = file.getvalue()
+    digest = hashlib.md5(pdf_bytes).hexdigest()
+
+    # Re-upload do mesmo ficheiro nesta sessão: só a chave reconhecida fica guardada,
+    # os dados vêm sempre do DB_HISTORICO atual
+    vistos = st.session_state.setdefault("pdf_rcc", {})
+    if digest not in vistos:
+        try:
+            text = _extrair_texto_pdf(digest, pdf_bytes)
+        except Exception as e:
+            st.error(f"Erro ao ler PDF: {e}")
+            return False, None, None
+
+        vistos[digest] = None
+        text_lower = text.lower()
+        for _, key in AUTOMATON.iter(text_lower):
+            vistos[digest] = key
+            break
 
+    key = vistos[digest]
+    if key not in DB_HISTORICO:
+        return False, None, None
+    return True, key, DB_HISTORICO[key]
+
+# Layout STL binário: cabeçalho de 80 bytes + nº de triângulos (uint32) + 50 bytes por triângulo
+STL_DTYPE = np.dtype([('n', '<f4', 3), ('v', '<f4', (3, 3)), ('attr', '<u2')])
+
+def fast_load_stl(buf):
+    """Lê STL binário diretamente com numpy; devolve None se não for binário (ex. ASCII)"""
+    if len(buf) < 84:
+        return None
+    n = struct.unpack('<I', buf[80:84])[0]
+    if len(buf) != 84 + n * STL_DTYPE.itemsize: # Muitos binários também começam por "solid"
+        return None
+    arr = np.frombuffer(buf, dtype=STL_DTYPE, count=n, offset=84)
+    verts = np.ascontiguousarray(arr['v'].reshape(-1, 3)) # cópia própria: não prende os bytes do upload
+    faces = np.arange(n * 3, dtype=np.int32).reshape(n, 3)
+    return verts, faces
+
+def _hash_upload(f):
+    # Calculado uma vez por objeto (cada rerun pede-o a várias funções em cache)
+    if not hasattr(f, "_md5"):
+        f._md5 = hashlib.md5(f.getvalue()).digest()
+    return f._md5
+
+# Malhas completas em memória do servidor: limitar a algumas e por pouco tempo
+@st.cache_resource(show_spinner=False, max_entries=4, ttl="1h", hash_funcs={UploadedFile: _hash_upload})
 def carregar_3d(uploaded_file, file_ext):
-    """Carrega STL usando Trimesh (Mais leve que CadQuery)"""
-    temp_filename = f"temp_mesh{file_ext}"
-    with open(temp_filename, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    
+    """Carrega a geometria como (vértices, faces); STL binário sem Trimesh, restantes via Trimesh"""
     try:
-        mesh = trimesh.load(temp_filename)
-        return mesh
+        if file_ext == ".stl":
+            buf = uploaded_file.getvalue()
+            malha = fast_load_stl(buf)
+            if malha is not None:
+                return malha
+            # STL ASCII lido diretamente da memória, sem ficheiro temporário
+            mesh = _get_trimesh().load(io.BytesIO(buf), file_type="stl")
+        else:
+            # STEP precisa de caminho em disco: ficheiro temporário único por pedido
+            uploaded_file.seek(0)
+            with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as tmp:
+                shutil.copyfileobj(uploaded_file, tmp)
+            try:
+                mesh = _get_trimesh().load(tmp.name)
+            finally:
+                os.unlink(tmp.name)
     except Exception as e:
         return None
 
+    if not isinstance(mesh, _get_trimesh().Trimesh) or mesh.is_empty:
+        return None
+    return np.asarray(mesh.vertices), np.asarray(mesh.faces)
+
+def volume_mm3(vertices, faces):
+    """Volume pelo teorema da divergência: soma dos volumes com sinal dos tetraedros (origem, triângulo)"""
+    tris = np.asarray(vertices, dtype=np.float64)[np.asarray(faces)] # (F, 3, 3)
+    return np.abs(np.einsum('ij,ij->i', tris[:, 0], np.cross(tris[:, 1], tris[:, 2])).sum() / 6.0)
+
+def fundir_vertices(vertices, faces):
+    """Funde vértices coincidentes (o STL binário traz três por face) e reindexa as faces"""
+    vertices, inverse = np.unique(vertices, axis=0, return_inverse=True)
+    return vertices, inverse.reshape(-1)[faces]
+
+def remover_faces_internas(vertices, faces):
+    """Remove pares de triângulos coincidentes com orientação oposta (paredes internas de uniões/multi-corpo);
+    duplicados com a mesma orientação ficam com uma só cópia. Espera vértices já fundidos."""
+    # Rodar cada triângulo para começar no menor índice (mantém a orientação)
+    rot = (np.argmin(faces, axis=1)[:, None] + np.arange(3)) % 3
+    rodadas = np.take_along_axis(faces, rot, axis=1)
+    sinal = np.where(rodadas[:, 1] < rodadas[:, 2], 1, -1)
+    chave = np.column_stack([rodadas[:, 0], np.minimum(rodadas[:, 1], rodadas[:, 2]), np.maximum(rodadas[:, 1], rodadas[:, 2])])
+    _, grupo = np.unique(chave, axis=0, return_inverse=True)
+    grupo = grupo.reshape(-1)
+
+    # Pares opostos anulam-se; do que sobra num grupo fica uma cópia com a orientação dominante
+    saldo = np.bincount(grupo, weights=sinal)
+    candidatas = np.flatnonzero(sinal == np.sign(saldo[grupo]))
+    _, primeira = np.unique(grupo[candidatas], return_index=True)
+    return vertices, faces[np.sort(candidatas[primeira])]
+
+def decimar_para_web(vertices, faces):
+    """Simplifica a malha só para visualização (orçamento de faces proporcional à complexidade)"""
+    # Vértices partilhados mesmo sem decimação: menos dados para o browser e sombreamento suave
+    vertices, faces = fundir_vertices(vertices, faces)
+
+    n_faces = len(faces)
+    target = min(n_faces, max(5000, int(n_faces * 0.15)), MAX_FACES_WEB)
+    if n_faces <= target * 1.2:
+        return vertices, faces
+
+    # Primeiro a "pele" exterior, depois a decimação
+    vertices, faces = remover_faces_internas(vertices, faces)
+
+    # Quadric decimation do Trimesh (backend fast-simplification); erros propagam-se: nunca enviar a malha completa
+    mesh = _get_trimesh().Trimesh(vertices=vertices, faces=faces).simplify_quadric_decimation(face_count=target)
+    return mesh.vertices, mesh.faces
+
+def calcular_preco(peso, vol_cm3):
+    """Preço = PRECO_COEFS · [peso, volume, 1]; aceita escalares ou arrays (orçamento em lote)"""
+    peso, vol_cm3 = np.broadcast_arrays(np.asarray(peso, dtype=np.float64), np.asarray(vol_cm3, dtype=np.float64))
+    return np.tensordot(PRECO_COEFS, np.stack([peso, vol_cm3, np.ones_like(peso)]), axes=1)
+
+def criar_figura_3d(vertices, faces):
+    """Figura Plotly da peça a partir dos arrays de vértices (N, 3) e faces (F, 3)"""
+    import plotly.graph_objects as go
+    # float32/int32: metade dos bytes enviados ao browser, precisão suficiente para visualização
+    vertices = np.asarray(vertices, dtype=np.float32)
+    tri = np.asarray(faces, dtype=np.int32)
+    fig = go.Figure(data=[go.Mesh3d(x=vertices[:, 0], y=vertices[:, 1], z=vertices[:, 2],
+                                    i=tri[:, 0], j=tri[:, 1], k=tri[:, 2],
+                                    color='cyan', opacity=0.8, name='Peça')])
+    fig.update_layout(scene=dict(aspectmode='data'), margin=dict(l=0, r=0, b=0, t=0), paper_bgcolor="rgba(0,0,0,0)")
+    return fig
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def analisar_3d(uploaded_file, file_ext):
+    """Volume da peça, calculado uma vez por ficheiro"""
+    malha = carregar_3d(uploaded_file, file_ext)
+    if malha is None or len(malha[1]) == 0:
+        return None
+    vertices, faces = malha
+
+    vol_cm3 = float(volume_mm3(vertices, faces)) / 1000
+    return {"vol_cm3": vol_cm3}
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl="1h")
+def preparar_figura_3d(digest, _vertices, _faces):
+    """Figura (em dict) da cópia simplificada, partilhada entre sessões (chave = MD5 do ficheiro)"""
+    return criar_figura_3d(*decimar_para_web(_vertices, _faces)).to_dict()
+
+def figura_3d_em_fundo(uploaded_file, file_ext):
+    """(digest, Future) da figura da peça, calculada fora da thread do script (um pedido por ficheiro)"""
+    if "decimate_executor" not in st.session_state:
+        st.session_state["decimate_executor"] = ThreadPoolExecutor(max_workers=2)
+    figuras = st.session_state.setdefault("figuras_3d", {})
+    digest = _hash_upload(uploaded_file)
+    fig_futura = figuras.pop(digest, None)
+    if fig_futura is None:
+        # Um rerun a meio (ex. mudar a quantidade) reaproveita o mesmo pedido
+        fig_futura = st.session_state["decimate_executor"].submit(preparar_figura_3d, digest, *carregar_3d(uploaded_file, file_ext))
+    figuras[digest] = fig_futura # (re)inserido no fim: os mais antigos saem primeiro
+    while len(figuras) > MAX_FIGURAS_SESSAO:
+        figuras.pop(next(iter(figuras)))
+    return digest, fig_futura
+
+def mostrar_figura_3d(digest, fig_futura):
+    """Desenha a figura já calculada; um pedido falhado é esquecido para o próximo rerun tentar de novo"""
+    import plotly.graph_objects as go
+    erro = fig_futura.exception()
+    if erro is not None:
+        st.session_state["figuras_3d"].pop(digest, None)
+        st.warning(f"⚠️ Visualização 3D indisponível: {erro}")
+        return
+    st.plotly_chart(go.Figure(fig_futura.result()), use_container_width=True)
+
+@st.fragment(run_every=1)
+def aguardar_figura_3d(fig_futura):
+    """Só esta área é re-executada enquanto a decimação corre; os widgets continuam livres"""
+    if fig_futura.done():
+        st.rerun() # rerun completo: desenha a figura e termina o polling
+    st.caption("⏳ A preparar visualização 3D...")
+
+@st.cache_data(show_spinner=False)
+def superficie_refrigeracao():
+    """Superfície estática do demo de canais conformais (calculada uma vez)"""
+    x = np.linspace(-2, 2, 50)
+    X, Y = np.meshgrid(x, x)
+    return np.sin(np.sqrt(X**2 + Y**2)).astype(np.float32)
+
+@st.cache_data(show_spinner=False)
+def campo_velocidade_cfd():
+    """Campo de velocidade do demo CFD, já em vetores 1-D (x, y, z, u, v, w) para o Plotly"""
+    eixo = np.arange(-5, 5, 2, dtype=np.float32)
+    n = eixo.size
+    # Índices da grelha num só bloco (mesma ordem do meshgrid 'xy'), sem grelhas 3-D intermédias
+    iy, ix, iz = np.indices((n, n, n), dtype=np.intp).reshape(3, -1)
+    x, y, z = eixo[ix], eixo[iy], eixo[iz]
+    return x, y, z, y, -x, z*0.1
+
 # --- UI SIDEBAR ---
 with st.sidebar:
     st.title("IndustriAI Pro")
@@ -118,9 +332,9 @@ if menu == "Orçamentação Inteligente":
                 if file_ext == ".step":
                      st.warning("⚠️ Nota: Para visualização web rápida, converta STEP para STL. A tentar processar...")
                 
-                mesh = carregar_3d(uploaded_file, file_ext)
+                analise = analisar_3d(uploaded_file, file_ext)
                 
-                if mesh and hasattr(mesh, 'volume'):
+                if analise:
                     st.markdown("""
                     <div class="info-box">
                         <h3 style="margin:0; color:#3b82f6">⚡ Geometria Processada</h3>
@@ -129,31 +343,26 @@ if menu == "Orçamentação Inteligente":
                     """, unsafe_allow_html=True)
                     
                     # Cálculos Físicos
-                    vol_cm3 = mesh.volume / 1000
-                    if vol_cm3 < 0: vol_cm3 *= -1
-                    peso = (vol_cm3 * 7.85) / 1000 # Aço
-                    preco = (peso * 18.5) + 120    # Lógica de preço simulada
+                    vol_cm3 = analise["vol_cm3"]
+                    peso = (vol_cm3 * DENSIDADE_ACO) / 1000 # Aço
+                    preco = float(calcular_preco(peso, vol_cm3))
                     
                     c1, c2 = st.columns(2)
                     c1.metric("Volume Real", f"{vol_cm3:.2f} cm³")
                     c1.metric("Peso Estimado (Aço)", f"{peso:.2f} kg")
                     c2.metric("Preço Calculado", f"€ {preco:.2f}")
 
-                    # Visualização Plotly
-                    if len(mesh.faces) > 10000:
-                         mesh = mesh.simplify_quadratic_decimation(5000) # Simplificar para web
-                    
-                    x, y, z = mesh.vertices.T
-                    i, j, k = mesh.faces.T
-                    
-                    fig = go.Figure(data=[go.Mesh3d(x=x, y=y, z=z, i=i, j=j, k=k, color='cyan', opacity=0.8, name='Peça')])
-                    fig.update_layout(scene=dict(aspectmode='data'), margin=dict(l=0, r=0, b=0, t=0), paper_bgcolor="rgba(0,0,0,0)")
-                    
+                    # Visualização Plotly em segundo plano, sem bloquear o script
+                    digest, fig_futura = figura_3d_em_fundo(uploaded_file, file_ext)
                     with chart_container:
-                        st.plotly_chart(fig, use_container_width=True)
+                        if fig_futura.done():
+                            mostrar_figura_3d(digest, fig_futura)
+                        else:
+                            aguardar_figura_3d(fig_futura)
 
 # --- VISTA 2: ENGENHARIA ---
 elif menu == "Engenharia & Design":
+    import plotly.graph_objects as go
     st.title("🌪️ Simulação e Engenharia")
     
     tab1, tab2 = st.tabs(["Design Generativo", "Túnel de Vento (CFD)"])
@@ -164,11 +373,7 @@ elif menu == "Engenharia & Design":
         if st.button("Gerar Canais (Demo)"):
             st.success("Estrutura otimizada gerada com sucesso! Ganho térmico: +34%")
             # Demo visual dummy
-            x = np.linspace(-2, 2, 50)
-            y = np.linspace(-2, 2, 50)
-            X, Y = np.meshgrid(x, y)
-            Z = np.sin(np.sqrt(X**2 + Y**2))
-            fig = go.Figure(data=[go.Surface(z=Z, colorscale='Electric')])
+            fig = go.Figure(data=[go.Surface(z=superficie_refrigeracao(), colorscale='Electric')])
             fig.update_layout(scene=dict(aspectmode='cube'), margin=dict(l=0,r=0,b=0,t=0))
             st.plotly_chart(fig)
 
@@ -176,9 +381,8 @@ elif menu == "Engenharia & Design":
         st.subheader("Análise de Fluido")
         st.info("Visualização do vetor de velocidade do fluido refrigerante.")
         # Cone plot demo
-        x, y, z = np.meshgrid(np.arange(-5, 5, 2), np.arange(-5, 5, 2), np.arange(-5, 5, 2))
-        u = y; v = -x; w = z*0.1
-        fig = go.Figure(data=go.Cone(x=x.flatten(), y=y.flatten(), z=z.flatten(), u=u.flatten(), v=v.flatten(), w=w.flatten(), sizemode="absolute", sizeref=2))
+        x, y, z, u, v, w = campo_velocidade_cfd()
+        fig = go.Figure(data=go.Cone(x=x, y=y, z=z, u=u, v=v, w=w, sizemode="absolute", sizeref=2))
         st.plotly_chart(fig)
 
 # --- VISTA 3: BASE DE MOLDES ---
@@ -202,5 +406,6 @@ elif menu == "Produção":
     st.title("🏭 Chão de Fábrica")
     st.error("⚠️ ALERTA CRÍTICO: Vibração excessiva no Fuso da CNC-02")
     
-    data = pd.DataFrame(np.random.randn(50, 3), columns=["CNC-01", "CNC-02", "EDM-01"])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.standard_normal((50, 3), dtype=np.float32), columns=["CNC-01", "CNC-02", "EDM-01"])
     st.line_chart(data)